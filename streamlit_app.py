@@ -1,120 +1,269 @@
 # streamlit_app.py
 
+import hashlib
+import io
+import re
+
 import streamlit as st
+import diskcache
 from google.oauth2 import service_account
 from google.cloud import bigquery
 import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.stats import chi2_contingency
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import math
 import numpy as np
-from scipy.stats import beta
 
-# Create API client.
-credentials = service_account.Credentials.from_service_account_info(
-    st.secrets["gcp_service_account"]
-)
-client = bigquery.Client(credentials=credentials)
+# Create API client once per process; reruns reuse the cached instance.
+@st.cache_resource
+def get_bq_client():
+    credentials = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"]
+    )
+    return bigquery.Client(credentials=credentials)
+
+QUERY_CACHE_TTL = 600
+MAX_BYTES_BILLED = 10 * 1024 ** 3  # refuse queries that would bill more than 10 GiB
+
+@st.cache_resource
+def get_disk_cache():
+    return diskcache.Cache("/tmp/bq_cache")
+
+def _normalize(sql):
+    # Strip -- comments (outside string literals) and collapse whitespace so
+    # trivially different spellings of the same query share a cache entry.
+    # Case and literal contents are preserved: folding them would collide
+    # semantically different queries onto one shared cache key.
+    out = []
+    i = 0
+    n = len(sql)
+    quote = None
+    while i < n:
+        ch = sql[i]
+        if quote is not None:
+            out.append(ch)
+            if ch == quote:
+                quote = None
+            i += 1
+        elif ch in ("'", '"', "`"):
+            quote = ch
+            out.append(ch)
+            i += 1
+        elif ch == "-" and sql.startswith("--", i):
+            while i < n and sql[i] != "\n":
+                i += 1
+        else:
+            out.append(ch)
+            i += 1
+    return re.sub(r"\s+", " ", "".join(out)).strip()
 
-# Perform query.
-@st.cache_data(ttl=600)
+# Perform query. st.cache_data is the in-memory L1; the diskcache keyed on a
+# hash of the normalized SQL survives process restarts and is shared across
+# sessions, so only a genuinely new query pays the BigQuery roundtrip.
+@st.cache_data(ttl=QUERY_CACHE_TTL)
 def run_query(query):
     try:
-        query_job = client.query(query)
-        rows_raw = query_job.result()
-        rows = [dict(row) for row in rows_raw]
-        df = pd.DataFrame(rows)
+        key = hashlib.sha256(_normalize(query).encode()).hexdigest()
+        cache = get_disk_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            return pd.read_parquet(io.BytesIO(cached))
+        client = get_bq_client()
+        # Estimate the scan with a free dry run before spending money or
+        # blocking the UI; the billing cap stops pathological queries cold.
+        dry = client.query(
+            query,
+            job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False),
+        )
+        st.info(f"Query will process an estimated {dry.total_bytes_processed:,} bytes.")
+        query_job = client.query(
+            query,
+            job_config=bigquery.QueryJobConfig(
+                maximum_bytes_billed=MAX_BYTES_BILLED, use_query_cache=True
+            ),
+        )
+        # Stream Arrow record batches over the BigQuery Storage API instead
+        # of marshalling each row into a Python dict.
+        df = query_job.result().to_dataframe(create_bqstorage_client=True)
+        cache.set(key, df.to_parquet(), expire=QUERY_CACHE_TTL)
         return df
     except Exception as e:
         st.error(f"An error occurred: {e}")
         return None
 
-def calculate_conversion_rates(df, event1_col, event2_col, assignment_col):
-    if df.empty or event1_col not in df.columns or event2_col not in df.columns or assignment_col not in df.columns:
-        return None, None
-    df["converted"] = ~df[event2_col].isnull()
-    conversion_rates = (
-        df.groupby(assignment_col)["converted"].agg(["count", "sum"]).reset_index()
+# Aggregate inside BigQuery: the whole pipeline reduces to four counts, so
+# wrapping the user's query and selecting COUNTIFs turns O(rows) egress and
+# client RAM into a single-row result.
+@st.cache_data(ttl=QUERY_CACHE_TTL)
+def run_counts_query(query, assignment_col, event2_col):
+    # Pasted SQL routinely ends in a semicolon, which is illegal inside a
+    # subquery; strip it, and close the wrapper on its own line so a trailing
+    # -- comment can't swallow the paren. The column names come from the
+    # result schema, so backtick-quote them.
+    body = re.sub(r"[;\s]+$", "", query)
+    assign = f"`{assignment_col}`"
+    event2 = f"`{event2_col}`"
+    agg_sql = (
+        f"SELECT "
+        f"COUNTIF({assign} = 'A') AS n_a, "
+        f"COUNTIF({assign} = 'A' AND {event2} IS NOT NULL) AS c_a, "
+        f"COUNTIF({assign} = 'B') AS n_b, "
+        f"COUNTIF({assign} = 'B' AND {event2} IS NOT NULL) AS c_b "
+        f"FROM (\n{body}\n)"
     )
-    conversion_rates["conversion_rate"] = (
-        conversion_rates["sum"] / conversion_rates["count"]
+    try:
+        client = get_bq_client()
+        # The COUNTIF wrapper scans the same bytes as the raw query, so it
+        # gets the same dry-run preview and billing cap.
+        dry = client.query(
+            agg_sql,
+            job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False),
+        )
+        st.info(f"Query will process an estimated {dry.total_bytes_processed:,} bytes.")
+        query_job = client.query(
+            agg_sql,
+            job_config=bigquery.QueryJobConfig(
+                maximum_bytes_billed=MAX_BYTES_BILLED, use_query_cache=True
+            ),
+        )
+        row = next(iter(query_job.result()))
+        return int(row["n_a"]), int(row["c_a"]), int(row["n_b"]), int(row["c_b"])
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
+        return None
+
+# numba costs ~1s of import time; defer it until the first analysis so a
+# cold start paints the UI without paying for it.
+@st.cache_resource
+def _counts_kernel():
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def _counts(assign_is_a, assign_is_b, event2_notna):
+        # Walk the uint8 arrays once, accumulating scalars, instead of
+        # allocating full bool temporaries for each mask combination. Arm B
+        # gets its own mask: rows with a NULL assignment belong to neither
+        # arm, matching what the aggregate-in-BQ COUNTIFs count.
+        n = assign_is_a.shape[0]
+        n_a = 0
+        c_a = 0
+        n_b = 0
+        c_b = 0
+        for i in prange(n):
+            a = assign_is_a[i]
+            b = assign_is_b[i]
+            m = event2_notna[i]
+            n_a += a
+            c_a += a & m
+            n_b += b
+            c_b += b & m
+        return n_a, c_a, n_b, c_b
+
+    return _counts
+
+def ab_counts(table, assignment_col, event2_col):
+    # One pass over the two hot columns; every downstream step (rates chart,
+    # z-test, posterior plot) reduces to these four scalars. Both masks come
+    # from SIMD-vectorized Arrow kernels rather than per-element pandas
+    # null/equality dispatch.
+    m = pc.is_valid(table[event2_col]).to_numpy(zero_copy_only=False)
+    a = pc.fill_null(pc.equal(table[assignment_col], "A"), False).to_numpy(
+        zero_copy_only=False
     )
-    if len(conversion_rates[assignment_col].unique()) == 2:
-        if "A" in conversion_rates[assignment_col].unique() and "B" in conversion_rates[assignment_col].unique():
-            variant_a_rate = conversion_rates[conversion_rates[assignment_col] == "A"]["conversion_rate"].iloc[0]
-            variant_b_rate = conversion_rates[conversion_rates[assignment_col] == "B"]["conversion_rate"].iloc[0]
-            lift_drop = (variant_b_rate - variant_a_rate) / variant_a_rate
-        else:
-            lift_drop = None
+    b = pc.fill_null(pc.equal(table[assignment_col], "B"), False).to_numpy(
+        zero_copy_only=False
+    )
+    m = np.ascontiguousarray(m).view(np.uint8)
+    a = np.ascontiguousarray(a).view(np.uint8)
+    b = np.ascontiguousarray(b).view(np.uint8)
+    n_a, c_a, n_b, c_b = _counts_kernel()(a, b, m)
+    return int(n_a), int(c_a), int(n_b), int(c_b)
+
+def calculate_conversion_rates(n_a, c_a, n_b, c_b, assignment_col):
+    if n_a == 0 or n_b == 0:
+        return None, None
+    variant_a_rate = c_a / n_a
+    variant_b_rate = c_b / n_b
+    conversion_rates = pd.DataFrame(
+        {assignment_col: ["A", "B"], "count": [n_a, n_b], "sum": [c_a, c_b],
+         "conversion_rate": [variant_a_rate, variant_b_rate]}
+    )
+    if variant_a_rate > 0:
+        lift_drop = (variant_b_rate - variant_a_rate) / variant_a_rate
     else:
         lift_drop = None
-    
+
     return conversion_rates, lift_drop
 
-def create_horizontal_conversion_chart(conversion_rates, assignment_col):
-    if conversion_rates is None:
-        return None
-    
-    fig, ax = plt.subplots()
-    bars = ax.barh(
-        conversion_rates[assignment_col],
-        conversion_rates["conversion_rate"],
-    )
-    
-    ax.set_xlabel("Conversion Rate")
-    ax.set_title("Conversion Rate by Assignment")
-    ax.set_xlim(0,1)
-    
-    for bar in bars:
-        width = bar.get_width()
-        ax.annotate(f'{width:.2%}',
-                    xy=(width, bar.get_y() + bar.get_height() / 2),
-                    xytext=(-30, 0),
-                    textcoords="offset points",
-                    ha='right', va='center', fontweight='bold', fontsize=14)
-    
-    return fig
+def ab_ztest(n_a, c_a, n_b, c_b):
+    # Two-proportion z-test; for a 2x2 table this is algebraically equivalent
+    # to the uncorrected chi-squared test, but needs only scalar arithmetic.
+    # Imported here so scipy stays off the cold-start path (Python caches
+    # the module after the first call).
+    from scipy.special import ndtr
 
-def perform_chi_squared_test(df, assignment_col):
-    if df is None or assignment_col not in df.columns or "converted" not in df.columns:
+    if n_a == 0 or n_b == 0:
+        return None
+    p_a = c_a / n_a
+    p_b = c_b / n_b
+    p_pooled = (c_a + c_b) / (n_a + n_b)
+    se = math.sqrt(p_pooled * (1 - p_pooled) * (1 / n_a + 1 / n_b))
+    if se == 0:
         return None
-    contingency_table = pd.crosstab(df[assignment_col], df["converted"])
-    chi2, p, dof, expected = chi2_contingency(contingency_table)
-    return chi2, p, dof, expected
+    z = (p_b - p_a) / se
+    p_value = 2 * (1 - ndtr(abs(z)))
+    return z, p_value
 
-def create_posterior_distribution_chart(df, assignment_col):
-    if df is None or assignment_col not in df.columns or "converted" not in df.columns:
+@lru_cache(maxsize=32)
+def _posterior_grid(lo, hi):
+    # Reruns with unchanged counts land on the same rounded band, so the
+    # grid allocation is paid once per distinct band.
+    return np.linspace(lo, hi, 400)
+
+def create_posterior_distribution_chart_from_counts(n_a, c_a, n_b, c_b):
+    if n_a == 0 or n_b == 0:
         return None
 
-    variants = df[assignment_col].unique()
-    if len(variants) != 2 or "A" not in variants or "B" not in variants:
-      return None
-    
-    fig, ax = plt.subplots()
-    x = np.linspace(0, 1, 1000)
-
-    for variant in variants:
-        variant_data = df[df[assignment_col] == variant]
-        successes = variant_data["converted"].sum()
-        failures = len(variant_data) - successes
-        
+    params = {}
+    for variant, successes, failures in [("A", c_a, n_a - c_a), ("B", c_b, n_b - c_b)]:
         # Beta distribution parameters
         a = successes + 1  # Adding 1 for a weak prior (uniform distribution)
         b = failures + 1
-        
-        posterior = beta.pdf(x, a, b)
-        ax.plot(x, posterior, label=f"{variant} (a={a}, b={b})")
 
-    ax.set_xlabel("Conversion Rate")
-    ax.set_ylabel("Posterior Density")
-    ax.set_title("Posterior Distribution of Conversion Rates")
-    ax.legend()
-    return fig
+        # Normal approximation to Beta(a, b): at A/B sample sizes the
+        # posterior is tightly concentrated, so a Gaussian evaluated on a
+        # narrow +/-6 sd band is indistinguishable from beta.pdf and skips
+        # thousands of lgamma calls.
+        mu = a / (a + b)
+        sd = np.sqrt(a * b / ((a + b) ** 2 * (a + b + 1)))
+        params[variant] = (mu, sd)
+
+    # Shared grid covering both variants' bands so st.line_chart can plot
+    # the curves from one indexed frame.
+    lo = max(0.0, min(mu - 6 * sd for mu, sd in params.values()))
+    hi = min(1.0, max(mu + 6 * sd for mu, sd in params.values()))
+    xg = _posterior_grid(round(lo, 4), round(hi, 4))
+    curves = {
+        variant: np.exp(-0.5 * ((xg - mu) / sd) ** 2) / (sd * np.sqrt(2 * np.pi))
+        for variant, (mu, sd) in params.items()
+    }
+    return pd.DataFrame(curves, index=pd.Index(xg, name="Conversion Rate"))
 
 st.title("BigQuery Query Interface")
 
+def get_df():
+    # Re-wrap the stored Arrow table on demand; ArrowDtype columns are
+    # zero-copy views over the table's buffers, so nothing gets pickled
+    # between reruns.
+    if st.session_state.df_arrow is None:
+        return None
+    return st.session_state.df_arrow.to_pandas(types_mapper=pd.ArrowDtype)
+
 # Initialize session state variables if they don't exist
-if 'df' not in st.session_state:
-    st.session_state.df = None
+if 'df_arrow' not in st.session_state:
+    st.session_state.df_arrow = None
 if "event1_column" not in st.session_state:
     st.session_state.event1_column = None
 if "event2_column" not in st.session_state:
@@ -126,8 +275,8 @@ if "assignment_column" not in st.session_state:
 with st.sidebar:
     st.header("Column Selection")
     
-    if st.session_state.df is not None:
-        all_columns = st.session_state.df.columns.tolist()
+    if st.session_state.df_arrow is not None:
+        all_columns = list(st.session_state.df_arrow.column_names)
     else:
         all_columns = [] #provide an empty list so the drop downs still render.
 
@@ -142,57 +291,125 @@ with st.sidebar:
     )
     
 
+def render_ab_analysis(n_a, c_a, n_b, c_b, assignment_col):
+    conversion_rates, lift_drop = calculate_conversion_rates(
+        n_a, c_a, n_b, c_b, assignment_col
+    )
+    if conversion_rates is None:
+        st.write("There was a problem with one of your column selections, or there is not both A and B assignments in your data")
+        return
+    # The analyses are independent, so overlap them; the NumPy/SciPy inner
+    # loops release the GIL.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        fut_ztest = executor.submit(ab_ztest, n_a, c_a, n_b, c_b)
+        fut_posterior = executor.submit(
+            create_posterior_distribution_chart_from_counts, n_a, c_a, n_b, c_b
+        )
+        ztest_result = fut_ztest.result()
+        posterior_data = fut_posterior.result()
+
+    # Vega-Lite via st.bar_chart skips the Agg rasterize/PNG-encode
+    # path matplotlib figures pay on every rerun.
+    st.bar_chart(
+        conversion_rates.set_index(assignment_col)[["conversion_rate"]],
+        horizontal=True,
+    )
+    if lift_drop is not None:
+        st.write(f"Lift/Drop of Variant B compared to Variant A: {lift_drop:.2%}")
+    else:
+        st.write("Could not calculate lift/drop, ensure you have a proper assignment column with values A and B")
+
+    if ztest_result is not None:
+        z, p = ztest_result
+        st.write(f"Two-Proportion Z-Test Results:")
+        st.write(f"Z Statistic: {z:.4f}")
+        st.write(f"P-value: {p:.4f}")
+
+        alpha = 0.05
+        if p < alpha:
+            st.write(f"Since the p-value ({p:.4f}) is less than alpha ({alpha}), we reject the null hypothesis. There is a statistically significant difference in conversion rates between the variants.")
+        else:
+            st.write(f"Since the p-value ({p:.4f}) is greater than alpha ({alpha}), we fail to reject the null hypothesis. There is no statistically significant difference in conversion rates between the variants.")
+    else:
+        st.write("There was a problem with your column selections, could not perform the z-test")
+
+    # Posterior distribution chart
+    if posterior_data is not None:
+        st.line_chart(posterior_data)
+    else:
+        st.write("Could not create posterior distribution chart. Ensure there are exactly two assignments named A and B")
+
 query_text = st.text_area("Enter your BigQuery SQL query here:", height=200)
+aggregate_in_bq = st.checkbox(
+    "Aggregate in BigQuery",
+    help="Reduce the query to the four A/B counts inside BigQuery instead of "
+    "downloading every row. Requires the columns to already be selected "
+    "(run once without this to populate the dropdowns).",
+)
 
 if st.button("Run Query"):
     if query_text:
-        with st.spinner("Running query..."):
-            st.session_state.df = run_query(query_text)
-        if st.session_state.df is not None:
-            st.write("Sample Data:")
-            st.table(st.session_state.df.head(10))
-            
-            
-            conversion_rates, lift_drop = calculate_conversion_rates(
-                st.session_state.df,
-                st.session_state.event1_column,
-                st.session_state.event2_column,
-                st.session_state.assignment_column,
-            )
-            if conversion_rates is not None:
-                st.session_state.df["converted"] = ~st.session_state.df[st.session_state.event2_column].isnull()
-
-                conversion_chart = create_horizontal_conversion_chart(conversion_rates,st.session_state.assignment_column)
-                if conversion_chart is not None:
-                    st.pyplot(conversion_chart)
-                if lift_drop is not None:
-                    st.write(f"Lift/Drop of Variant B compared to Variant A: {lift_drop:.2%}")
-                else:
-                    st.write("Could not calculate lift/drop, ensure you have a proper assignment column with values A and B")
-            else:
-                st.write("There was a problem with one of your column selections, or there is not both A and B assignments in your data")
-
-            chi2_result = perform_chi_squared_test(st.session_state.df, st.session_state.assignment_column)
-            if chi2_result is not None:
-              chi2, p, dof, expected = chi2_result
-              st.write(f"Chi-Squared Test Results:")
-              st.write(f"Chi-Squared Statistic: {chi2:.4f}")
-              st.write(f"P-value: {p:.4f}")
-              st.write(f"Degrees of Freedom: {dof}")
-
-              alpha = 0.05
-              if p < alpha:
-                  st.write(f"Since the p-value ({p:.4f}) is less than alpha ({alpha}), we reject the null hypothesis. There is a statistically significant difference in conversion rates between the variants.")
-              else:
-                  st.write(f"Since the p-value ({p:.4f}) is greater than alpha ({alpha}), we fail to reject the null hypothesis. There is no statistically significant difference in conversion rates between the variants.")
+        if aggregate_in_bq:
+            if not st.session_state.event2_column or not st.session_state.assignment_column:
+                st.warning("Select the event and assignment columns first — run the query once without aggregation to populate them.")
             else:
-              st.write("There was a problem with your column selections, could not perform chi-squared test")
+                with st.spinner("Running aggregate query..."):
+                    counts = run_counts_query(
+                        query_text,
+                        st.session_state.assignment_column,
+                        st.session_state.event2_column,
+                    )
+                if counts is not None:
+                    render_ab_analysis(*counts, st.session_state.assignment_column)
+        else:
+            with st.spinner("Running query..."):
+                df = run_query(query_text)
+            if df is not None:
+                # Low-cardinality assignment column: categorical codes become
+                # a dictionary-encoded Arrow column, halving its memory.
+                if st.session_state.assignment_column in df.columns:
+                    df[st.session_state.assignment_column] = (
+                        df[st.session_state.assignment_column].astype("category")
+                    )
+                # Persist as Arrow rather than a pandas object with Python
+                # strings, so reruns don't re-pickle the whole frame.
+                st.session_state.df_arrow = pa.Table.from_pandas(df)
+                df = get_df()
+                st.write("Sample Data:")
+                st.dataframe(df.head(10), use_container_width=True)
 
-            # Posterior distribution chart
-            posterior_chart = create_posterior_distribution_chart(st.session_state.df, st.session_state.assignment_column)
-            if posterior_chart is not None:
-                st.pyplot(posterior_chart)
-            else:
-                st.write("Could not create posterior distribution chart. Ensure there are exactly two assignments named A and B")
+                event2_col = st.session_state.event2_column
+                assignment_col = st.session_state.assignment_column
+                table = st.session_state.df_arrow
+                # Cheap misconfiguration guards before any aggregation work:
+                # null_count is Arrow metadata, so the all-null check is O(1).
+                if st.session_state.event1_column == event2_col:
+                    st.warning("Event 1 and Event 2 must be different columns.")
+                    st.stop()
+                if event2_col in table.column_names and table[event2_col].null_count == len(table):
+                    st.warning("The selected Event 2 column is entirely null, so there are no conversions to analyze.")
+                    st.stop()
+                if (assignment_col in table.column_names
+                        # count_distinct has no dictionary kernel, and the
+                        # assignment column is dictionary-encoded by the
+                        # category cast above, so decode it first.
+                        and pc.count_distinct(
+                            table[assignment_col].cast(pa.string())
+                        ).as_py() < 2):
+                    st.warning("The assignment column needs at least two variants (A and B).")
+                    st.stop()
+                if (not df.empty
+                        and st.session_state.event1_column in df.columns
+                        and event2_col in df.columns
+                        and assignment_col in df.columns
+                        and set(df[assignment_col].dropna().unique().tolist()) == {"A", "B"}):
+                    # Scan the assignment/event2 columns once; all the analyses
+                    # consume these four counts.
+                    n_a, c_a, n_b, c_b = ab_counts(
+                        st.session_state.df_arrow, assignment_col, event2_col
+                    )
+                    render_ab_analysis(n_a, c_a, n_b, c_b, assignment_col)
+                else:
+                    st.write("There was a problem with one of your column selections, or there is not both A and B assignments in your data")
     else:
         st.warning("Please enter a query.")